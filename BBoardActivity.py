@@ -62,11 +62,13 @@ except(ImportError, AttributeError):
 from StringIO import StringIO
 
 from sprites import Sprites, Sprite
+from cache import PreviewCache, LRUCache, MemoryBudget, surface_size, \
+    pixbuf_size
 from exportpdf import save_pdf
-from utils import get_path, lighter_color, svg_str_to_pixbuf, \
-    play_audio_from_file, get_pixbuf_from_journal, genblank, get_hardware, \
-    svg_rectangle, pixbuf_to_base64, base64_to_pixbuf, file_to_base64, \
-    base64_to_file
+from utils import get_path, lighter_color, play_audio_from_file, \
+    get_pixbuf_from_journal, get_hardware, pixbuf_to_base64, \
+    base64_to_pixbuf, file_to_base64, base64_to_file, blank_shape, \
+    frame_shape, pixbuf_to_surface, load_pixbuf_at_size
 from toolbar_utils import radio_factory, \
     button_factory, separator_factory, combo_factory, label_factory
 from grecord import Grecord
@@ -92,6 +94,21 @@ DESCRIPTIONX = 50
 DESCRIPTIONY = 550
 MAXX = 160
 MAXY = 120
+PDFW = 300
+PDFH = 225
+# Sizes at which slide images are decoded: thumbnail, PDF, and preview
+LEVELS = [(MAXX, MAXY), (PDFW, PDFH), (PREVIEWW, PREVIEWH)]
+LEVEL_CACHE_BYTES = 8 * 1024 * 1024
+MEMORY_BUDGET = 24 * 1024 * 1024
+PEER_CACHE_BYTES = 64 * 1024 * 1024
+PEER_MTIME = 'peer'  # previews from peers are cached under this mtime
+THUMBW_MIN = 160  # thumbnails are never narrower than this
+THUMB_OVERSCAN = 1  # rows of thumbnails kept beyond those in view
+FRAME_INTERVAL = 16  # ms between drag updates (~60 per second)
+AUTOSCROLL_EDGE = 40  # a thumbnail dragged this near an edge scrolls
+AUTOSCROLL_STEP = 12  # pixels scrolled per frame while it is there
+PREVIEW_CACHE_BYTES = 8 * 1024 * 1024
+PREFETCH_BYTES = PREVIEW_CACHE_BYTES / 2
 
 # sprite layers
 DRAG = 6
@@ -102,9 +119,22 @@ BOTTOM = 1
 HIDE = 0
 
 
+def _level_size(width, height):
+    ''' The smallest of LEVELS that covers width x height '''
+    for size in LEVELS:
+        if size[0] >= width and size[1] >= height:
+            return size
+    return (int(width), int(height))
+
+
 class Slide():
     ''' A container for a slide '''
 
+    # Images of the slides at sizes above that of the pixbuf, shared by
+    # all slides so that the least recently used are dropped first
+    levels = LRUCache(max_entries=None, max_bytes=LEVEL_CACHE_BYTES,
+                      sizeof=pixbuf_size)
+
     def __init__(self, owner, uid, colors, title, pixbuf, desc):
         self.owner = owner
         self.uid = uid
@@ -112,6 +142,30 @@ class Slide():
         self.title = title
         self.pixbuf = pixbuf
         self.desc = desc
+        self.version = 0  # incremented whenever the preview changes
+        self.source = None  # function (width, height) -> pixbuf
+
+    def get_pixbuf(self, width, height):
+        ''' Return the smallest image of the slide that covers width x
+        height, decoding it from the source the first time it is asked
+        for. Without a source, the pixbuf is as good as it gets. '''
+        if self.pixbuf is None or self.source is None or \
+                (self.pixbuf.get_width() >= width and
+                 self.pixbuf.get_height() >= height):
+            return self.pixbuf
+        size = _level_size(width, height)
+        key = (self.uid, self.version) + size
+        pixbuf = Slide.levels.get(key)
+        if pixbuf is None:
+            try:
+                pixbuf = self.source(*size)
+            except (gobject.GError, IOError), e:
+                _logger.error('Could not load %s at %dx%d: %s' %
+                              (self.uid, size[0], size[1], e))
+            if pixbuf is None:
+                pixbuf = self.pixbuf
+            Slide.levels.put(key, pixbuf)
+        return pixbuf
 
 
 class BBoardActivity(activity.Activity):
@@ -132,15 +186,23 @@ class BBoardActivity(activity.Activity):
         self._setup_toolbars()
         self._setup_canvas()
 
+        # slide index -> [sprite, x, y, index, what the sprite shows,
+        #                 whether the scaled preview has been drawn]
+        self._thumbs = {}
+        self._thumb_index = {}  # sprite -> slide index
+        self._spare_thumbs = []  # hidden thumbnail sprites for reuse
+        self._thumb_queue = []  # thumbnails waiting for their preview
+        self._thumb_fill_id = None
+        self._thumb_layout = None
+        self._thumb_scroll = 0
+        self._thumbnail_mode = False
+
         self.slides = []
         self._setup_workspace()
 
         self._buddies = [profile.get_nick_name()]
         self._setup_presence_service()
 
-        self._thumbs = []
-        self._thumbnail_mode = False
-
         self._recording = False
         self._grecord = None
         self._alert = None
@@ -159,12 +221,20 @@ class BBoardActivity(activity.Activity):
         self._canvas.set_flags(gtk.CAN_FOCUS)
         self._canvas.add_events(gtk.gdk.BUTTON_PRESS_MASK)
         self._canvas.add_events(gtk.gdk.POINTER_MOTION_MASK)
+        self._canvas.add_events(gtk.gdk.POINTER_MOTION_HINT_MASK)
         self._canvas.add_events(gtk.gdk.BUTTON_RELEASE_MASK)
         self._canvas.add_events(gtk.gdk.KEY_PRESS_MASK)
+        self._canvas.add_events(gtk.gdk.SCROLL_MASK)
         self._canvas.connect("expose-event", self._expose_cb)
         self._canvas.connect("button-press-event", self._button_press_cb)
         self._canvas.connect("button-release-event", self._button_release_cb)
         self._canvas.connect("motion-notify-event", self._mouse_move_cb)
+        self._canvas.connect("scroll-event", self._scroll_cb)
+        self._canvas.connect("key-press-event", self._key_press_cb)
+        self._drag_frame_id = None
+        self._autoscroll_id = None
+        self._drag_to = None
+        self._drag_stats = {'events': 0, 'merged': 0, 'frames': 0}
 
     def _setup_workspace(self):
         ''' Prepare to render the datastore entries. '''
@@ -186,33 +256,49 @@ class BBoardActivity(activity.Activity):
             titlef = 36
             descriptionf = 24
 
+        # Only the metadata is read up front; the preview images are
+        # decoded in the background once the first slide is showing.
         self._find_starred()
+        self._preview_cache = PreviewCache(
+            os.path.join(get_path(activity, 'instance'), 'previews'))
+        # Previews from peers cannot be decoded again, so they are kept
+        # on disk (in a roomier cache) while they are out of memory.
+        self._peer_cache = PreviewCache(
+            os.path.join(get_path(activity, 'instance'), 'peers'),
+            max_bytes=PEER_CACHE_BYTES)
+        # uid -> Journal object (or None, from a peer) of the slides
+        # whose pixbuf is yet to be decoded or has been dropped
+        self._undecoded = {}
+        self._evicted = set()  # uids of slides whose pixbuf was dropped
+        self._journal_objects = {}
+        self._decode_queue = []
         for ds in self.dsobjects:
             if 'title' in ds.metadata:
                 title = ds.metadata['title']
             else:
                 title = None
-            pixbuf = None
-            media_object = False
-            mimetype = None
-            if 'mime_type' in ds.metadata:
-                mimetype = ds.metadata['mime_type']
-            if mimetype[0:5] == 'image':
-                pixbuf = gtk.gdk.pixbuf_new_from_file_at_size(
-                    ds.file_path, MAXX, MAXY)
-                    # ds.file_path, 300, 225)
-                media_object = True
-            else:
-                pixbuf = get_pixbuf_from_journal(ds, MAXX, MAXY)  # 300, 225)
             if 'description' in ds.metadata:
                 desc = ds.metadata['description']
             else:
                 desc = None
             self.slides.append(Slide(True, ds.object_id, self.colors,
-                                     title, pixbuf, desc))
+                                     title, None, desc))
+            self._undecoded[ds.object_id] = ds
+            self._journal_objects[ds.object_id] = ds
+            self._decode_queue.append(self.slides[-1])
+
+        # Scaled preview surfaces, keyed by slide uid
+        self._preview_surfaces = LRUCache(max_entries=None,
+                                          max_bytes=PREVIEW_CACHE_BYTES,
+                                          sizeof=surface_size)
+
+        if len(self.slides) > 0:
+            self._decode_slide(self.slides[0])
 
         # Generate the sprites we'll need...
         self._sprites = Sprites(self._canvas)
+        # Only dragged thumbnails move; everything else is static.
+        self._sprites.set_backing_store(DRAG)
 
         self._help = Sprite(
             self._sprites,
@@ -223,24 +309,48 @@ class BBoardActivity(activity.Activity):
                 int(PREVIEWW * self._scale), int(PREVIEWH * self._scale)))
         self._help.hide()
 
-        self._genblanks(self.colors)
+        # Background shapes, keyed by screen size and color pair
+        self._blanks = LRUCache(max_entries=8)
+        title_blank, preview_blank, desc_blank, canvas_blank = \
+            self._genblanks(self.colors)
 
-        self._title = Sprite(self._sprites, 0, 0, self._title_pixbuf)
+        self._title = Sprite(self._sprites, 0, 0, title_blank)
         self._title.set_label_attributes(int(titlef * self._scale),
                                          rescale=False)
         self._preview = Sprite(self._sprites,
             int((self._width - int(PREVIEWW * self._scale)) / 2),
-            int(PREVIEWY * self._scale), self._preview_pixbuf)
+            int(PREVIEWY * self._scale), preview_blank)
 
         self._description = Sprite(self._sprites,
                                    int(DESCRIPTIONX * self._scale),
                                    int(DESCRIPTIONY * self._scale),
-                                   self._desc_pixbuf)
-        self._description.set_label_attributes(int(descriptionf * self._scale))
+                                   desc_blank)
+        self._description.set_label_attributes(int(descriptionf * self._scale),
+                                               wrap=True)
 
-        self._my_canvas = Sprite(self._sprites, 0, 0, self._canvas_pixbuf)
+        self._my_canvas = Sprite(self._sprites, 0, 0, canvas_blank)
         self._my_canvas.set_layer(BOTTOM)
 
+        # Everything that can be re-created is dropped, least-recently
+        # used first, to stay within the memory budget. The cheapest to
+        # re-create go first; the sprites on show are only reported.
+        self._slide_use = LRUCache(max_entries=None)  # uids, as shown
+        self._budget = MemoryBudget(MEMORY_BUDGET)
+        self._budget.track('hidden thumbnails', self._thumb_bytes,
+                           self._shrink_thumbs)
+        # Must come straight after the thumbnails, whose surfaces it takes.
+        self._budget.track('surface pool', lambda: self._sprites.pool.bytes,
+                           self._sprites.pool.shrink)
+        self._budget.track('previews', lambda: self._preview_surfaces.bytes,
+                           self._preview_surfaces.shrink)
+        self._budget.track('slide levels', lambda: Slide.levels.bytes,
+                           Slide.levels.shrink)
+        self._budget.track('slide pixbufs', self._pixbuf_bytes,
+                           self._shrink_pixbufs)
+        self._budget.track('sprites', self._sprites.get_bytes)
+
+        self._prefetch_id = None
+        self._refine_id = None
         self._clear_screen()
 
         self.i = 0
@@ -249,18 +359,179 @@ class BBoardActivity(activity.Activity):
         self._playing = False
         self._rate = 10
 
+        if len(self._undecoded) > 0:
+            self._decode_id = gobject.idle_add(self._decode_next_slide)
+        else:
+            self._decode_id = None
+
+    def _load_pixbuf(self, ds, width=MAXX, height=MAXY):
+        ''' Load a pixbuf of a Journal object (by default, of thumbnail
+        size). '''
+        mimetype = None
+        if 'mime_type' in ds.metadata:
+            mimetype = ds.metadata['mime_type']
+        if mimetype is not None and mimetype[0:5] == 'image':
+            return load_pixbuf_at_size(ds.file_path, width, height)
+        else:
+            return get_pixbuf_from_journal(ds, width, height)
+
+    def _decode_slide(self, slide):
+        ''' Decode the preview for a slide if it is still pending, or
+        restore one that was dropped to save memory. '''
+        if slide.uid not in self._undecoded:
+            return False
+        ds = self._undecoded.pop(slide.uid)
+        if slide.uid in self._evicted:
+            self._evicted.remove(slide.uid)  # the same preview as before
+        else:
+            self._preview_surfaces.remove(slide.uid)
+            slide.version += 1
+        if ds is None:
+            slide.pixbuf = self._peer_cache.get(slide.uid, PEER_MTIME)
+            self._peer_cache.unpin(slide.uid, PEER_MTIME)
+            if slide.pixbuf is None:
+                _logger.error('Could not restore preview for %s' %
+                              (slide.uid))
+            return True
+        # Larger images are decoded from the Journal object on demand.
+        slide.source = lambda width, height: \
+            self._load_pixbuf(ds, width, height)
+        mtime = self._get_mtime(ds)
+        slide.pixbuf = self._preview_cache.get(slide.uid, mtime)
+        if slide.pixbuf is not None:
+            return True
+        try:
+            slide.pixbuf = self._load_pixbuf(ds)
+        except (gobject.GError, IOError), e:
+            _logger.error('Could not load preview for %s: %s' % (slide.uid, e))
+            slide.pixbuf = None
+        self._preview_cache.put(slide.uid, mtime, slide.pixbuf)
+        return True
+
+    def _get_mtime(self, ds):
+        ''' When was this Journal object last modified? '''
+        for key in ['mtime', 'timestamp']:
+            if key in ds.metadata:
+                return ds.metadata[key]
+        return ''
+
+    def _decode_next_slide(self):
+        ''' Idle callback: decode one pending slide per iteration. '''
+        # The slide being looked at takes precedence over the queue.
+        if len(self.slides) > 0 and self._decode_slide(self.slides[self.i]):
+            self._slide_ready(self.i)
+        else:
+            while len(self._decode_queue) > 0:
+                slide = self._decode_queue.pop(0)
+                if self._decode_slide(slide):
+                    self._slide_ready(self.slides.index(slide))
+                    break
+        self._budget.enforce()
+        # Dropped pixbufs are left to be restored when they are needed.
+        if len(self._decode_queue) == 0:
+            self._decode_id = None
+            return False
+        return True
+
+    def _use_slide(self, slide):
+        ''' Note that a slide is being shown, restoring its pixbuf if it
+        was dropped to save memory. '''
+        if slide.uid in self._evicted:
+            self._decode_slide(slide)
+        self._slide_use.put(slide.uid, True)
+
+    def _on_screen(self):
+        ''' The uids of the slides on show '''
+        if self._thumbnail_mode:
+            return set([self.slides[i].uid for i in self._thumbs])
+        elif self.i < len(self.slides):
+            return set([self.slides[self.i].uid])
+        return set()
+
+    def _pixbuf_bytes(self):
+        ''' How many bytes do the slide pixbufs hold? '''
+        return sum([pixbuf_size(slide.pixbuf) for slide in self.slides
+                    if slide.pixbuf is not None])
+
+    def _shrink_pixbufs(self, nbytes):
+        ''' Drop the pixbufs of slides that are not on show, those never
+        shown first, then the least-recently shown, until nbytes have
+        been freed. Local slides are restored from the preview cache or
+        the Journal; those from peers are kept on disk until needed. '''
+        on_screen = self._on_screen()
+        shown = self._slide_use.keys()
+        slides = dict([(slide.uid, slide) for slide in self.slides])
+        order = [slide for slide in self.slides
+                 if slide.uid not in self._slide_use] + \
+            [slides[uid] for uid in shown if uid in slides]
+        freed = 0
+        for slide in order:
+            if freed >= nbytes:
+                break
+            if slide.pixbuf is None or slide.uid in on_screen or \
+                    slide.uid in self._undecoded:
+                continue
+            if slide.uid in self._journal_objects:
+                self._undecoded[slide.uid] = \
+                    self._journal_objects[slide.uid]
+            elif self._peer_cache.put(slide.uid, PEER_MTIME, slide.pixbuf,
+                                      pin=True):
+                self._undecoded[slide.uid] = None
+            else:
+                continue
+            self._evicted.add(slide.uid)
+            freed += pixbuf_size(slide.pixbuf)
+            slide.pixbuf = None
+        return freed
+
+    def _thumb_bytes(self):
+        ''' How many bytes do the hidden thumbnail sprites hold? (Those
+        on show are counted with the sprites.) '''
+        return sum([thumb[0].get_bytes() for thumb in self._thumbs.values()
+                    if not self._sprites.in_list(thumb[0])])
+
+    def _shrink_thumbs(self, nbytes):
+        ''' Recycle hidden thumbnails, which are drawn again when the
+        thumbnails are next shown, until nbytes have been moved to the
+        surface pool. Nothing is freed until the pool, which comes
+        next, is shrunk, so report nothing freed here. '''
+        if self._thumbnail_mode:
+            return 0
+        moved = 0
+        for i in self._thumbs.keys():
+            if moved >= nbytes:
+                break
+            moved += self._thumbs[i][0].get_bytes()
+            self._recycle_thumb(i)
+        return 0
+
+    def _slide_ready(self, i):
+        ''' A preview has been decoded: refresh it if it is on screen. '''
+        if self._thumbnail_mode:
+            if i in self._thumbs:
+                cols, w, h, x_off = self._thumb_layout
+                x, y = self._thumbs[i][1:3]
+                spr = self._show_thumb(i, x, y, w, h)
+                if spr is not None:
+                    spr.set_layer(TOP)
+        elif i == self.i:
+            self._show_slide()
+
     def _genblanks(self, colors):
-        ''' Need to cache these '''
-        self._title_pixbuf = svg_str_to_pixbuf(
-            genblank(self._width, int(TITLEH * self._scale), colors))
-        self._preview_pixbuf = svg_str_to_pixbuf(
-            genblank(int(PREVIEWW * self._scale), int(PREVIEWH * self._scale),
-                     colors))
-        self._desc_pixbuf = svg_str_to_pixbuf(
-            genblank(int(self._width - (2 * DESCRIPTIONX * self._scale)),
-                     int(DESCRIPTIONH * self._scale), colors))
-        self._canvas_pixbuf = svg_str_to_pixbuf(
-            genblank(self._width, self._height, (colors[0], colors[0])))
+        ''' Look up (or build) the backgrounds for a color pair. '''
+        key = (self._width, self._height, colors[0], colors[1])
+        blanks = self._blanks.get(key)
+        if blanks is None:
+            sizes = [(self._width, int(TITLEH * self._scale)),
+                     (int(PREVIEWW * self._scale),
+                      int(PREVIEWH * self._scale)),
+                     (int(self._width - (2 * DESCRIPTIONX * self._scale)),
+                      int(DESCRIPTIONH * self._scale))]
+            blanks = [blank_shape(w, h, colors) for w, h in sizes]
+            blanks.append(blank_shape(self._width, self._height,
+                                      (colors[0], colors[0])))
+            self._blanks.put(key, blanks)
+        return blanks
 
     def _setup_toolbars(self):
         ''' Setup the toolbars. '''
@@ -425,11 +696,14 @@ class BBoardActivity(activity.Activity):
     def _save_as_pdf_cb(self, button=None):
         ''' Export an PDF version of the slideshow to the Journal. '''
         _logger.debug('saving to PDF...')
+        for slide in self.slides:
+            self._decode_slide(slide)
         if 'description' in self.metadata:
             tmp_file = save_pdf(self, self._buddies,
                                 description=self.metadata['description'])
         else:
             tmp_file = save_pdf(self, self._buddies)
+        self._budget.enforce()
         _logger.debug('copying PDF file to Journal...')
         dsobject = datastore.create()
         dsobject.metadata['title'] = profile.get_nick_name() + ' ' + \
@@ -448,9 +722,8 @@ class BBoardActivity(activity.Activity):
         self._preview.hide()
         self._description.hide()
         if hasattr(self, '_thumbs'):
-            for thumbnail in self._thumbs:
+            for thumbnail in self._thumbs.values():
                 thumbnail[0].hide()
-        self.invalt(0, 0, self._width, self._height)
 
         # Reset drag settings
         self._press = None
@@ -458,63 +731,155 @@ class BBoardActivity(activity.Activity):
         self._dragpos = [0, 0]
         self._total_drag = [0, 0]
         self.last_spr_moved = None
+        self._cancel_drag_frame()
+        self._cancel_refine()
 
     def _update_colors(self):
         ''' Match the colors to those of the slide originator. '''
         if len(self.slides) == 0:
             return
-        self._genblanks(self.slides[self.i].colors)
-        self._title.set_image(self._title_pixbuf)
-        self._preview.set_image(self._preview_pixbuf)
-        self._description.set_image(self._desc_pixbuf)
-        self._my_canvas.set_image(self._canvas_pixbuf)
+        title_blank, preview_blank, desc_blank, canvas_blank = \
+            self._genblanks(self.slides[self.i].colors)
+        self._title.set_image(title_blank)
+        self._preview.set_image(preview_blank)
+        self._description.set_image(desc_blank)
+        # The other sprites are repainted when they are next shown, but
+        # the canvas is always on show, so repaint it if it changed.
+        if self._my_canvas.cached_surfaces[0] is not canvas_blank:
+            self._my_canvas.set_shape(canvas_blank)
 
     def _show_slide(self, direction=1):
         ''' Display a title, preview image, and decription for slide. '''
-        self._clear_screen()
-        self._update_colors()
+        with self._sprites.batch():
+            self._clear_screen()
+            self._update_colors()
+
+            if len(self.slides) == 0:
+                self._prev_button.set_icon('go-previous-inactive')
+                self._next_button.set_icon('go-next-inactive')
+                self._description.set_label(
+                    _('Do you have any items in your Journal starred?'))
+                self._help.set_layer(TOP)
+                self._description.set_layer(MIDDLE)
+                return
 
-        if len(self.slides) == 0:
-            self._prev_button.set_icon('go-previous-inactive')
-            self._next_button.set_icon('go-next-inactive')
-            self._description.set_label(
-                _('Do you have any items in your Journal starred?'))
-            self._help.set_layer(TOP)
-            self._description.set_layer(MIDDLE)
-            return
+            self._use_slide(self.slides[self.i])
+            if self.i == 0:
+                self._prev_button.set_icon('go-previous-inactive')
+            else:
+                self._prev_button.set_icon('go-previous')
+            if self.i == len(self.slides) - 1:
+                self._next_button.set_icon('go-next-inactive')
+            else:
+                self._next_button.set_icon('go-next')
 
-        if self.i == 0:
-            self._prev_button.set_icon('go-previous-inactive')
-        else:
-            self._prev_button.set_icon('go-previous')
-        if self.i == len(self.slides) - 1:
-            self._next_button.set_icon('go-next-inactive')
-        else:
-            self._next_button.set_icon('go-next')
+            if self.slides[self.i].pixbuf is not None:
+                self._preview.set_shape(
+                    self._preview_surface(self.slides[self.i]))
+                self._preview.set_layer(MIDDLE)
+            else:
+                if self._preview is not None:
+                    self._preview.hide()
+
+            self._title.set_label(self.slides[self.i].title)
+            self._title.set_layer(MIDDLE)
+
+            if self.slides[self.i].desc is not None:
+                self._description.set_label(self.slides[self.i].desc)
+                self._description.set_layer(MIDDLE)
+                text_buffer = gtk.TextBuffer()
+                text_buffer.set_text(self.slides[self.i].desc)
+                self._text_view.set_buffer(text_buffer)
+            else:
+                self._description.set_label('')
+                self._description.hide()
+
+            self._schedule_prefetch(direction)
+        self._budget.enforce()
+
+    def _schedule_prefetch(self, direction=1):
+        ''' Prepare the neighboring slides while this one is on show. '''
+        self._cancel_prefetch()
+        self._prefetch_queue = []
+        for offset in [1, -1, 2, -2]:
+            j = self.i + offset * direction
+            if j >= 0 and j < len(self.slides):
+                self._prefetch_queue.append(self.slides[j])
+        self._prefetch_bytes = 0
+        if len(self._prefetch_queue) > 0:
+            self._prefetch_id = gobject.idle_add(self._prefetch_next)
+
+    def _cancel_prefetch(self):
+        ''' Drop any prefetching left over from the previous slide. '''
+        if self._prefetch_id is not None:
+            gobject.source_remove(self._prefetch_id)
+            self._prefetch_id = None
+
+    def _prefetch_next(self):
+        ''' Idle callback: prepare one neighboring slide per iteration. '''
+        slide = self._prefetch_queue.pop(0)
+        self._decode_slide(slide)
+        # Likely to be shown next, so keep it over older slides.
+        self._slide_use.put(slide.uid, True)
+        self._budget.enforce()
+        # Laying out the labels is the slow part of showing a slide.
+        self._title.fit_label(slide.title)
+        if slide.desc is not None:
+            self._description.fit_label(slide.desc)
+        if slide.pixbuf is not None and \
+                slide.uid not in self._preview_surfaces and \
+                self._prefetch_bytes < PREFETCH_BYTES:
+            self._prefetch_bytes += surface_size(
+                self._smooth_preview(slide))
+        if len(self._prefetch_queue) == 0:
+            self._prefetch_id = None
+            return False
+        return True
 
-        pixbuf = self.slides[self.i].pixbuf
-        if pixbuf is not None:
-            self._preview.set_shape(pixbuf.scale_simple(
+    def _preview_surface(self, slide):
+        ''' Return the scaled preview for a slide, reusing a cached one.
+        If there is none, return a quick, coarse scaling of the pixbuf
+        for now and make a smooth one when the UI is idle. '''
+        surface = self._preview_surfaces.get(slide.uid)
+        if surface is None:
+            surface = pixbuf_to_surface(slide.pixbuf.scale_simple(
                     int(PREVIEWW * self._scale),
                     int(PREVIEWH * self._scale),
                     gtk.gdk.INTERP_NEAREST))
-            self._preview.set_layer(MIDDLE)
-        else:
-            if self._preview is not None:
-                self._preview.hide()
-
-        self._title.set_label(self.slides[self.i].title)
-        self._title.set_layer(MIDDLE)
-
-        if self.slides[self.i].desc is not None:
-            self._description.set_label(self.slides[self.i].desc)
-            self._description.set_layer(MIDDLE)
-            text_buffer = gtk.TextBuffer()
-            text_buffer.set_text(self.slides[self.i].desc)
-            self._text_view.set_buffer(text_buffer)
-        else:
-            self._description.set_label('')
-            self._description.hide()
+            self._cancel_refine()
+            self._refine_id = gobject.idle_add(self._refine_preview, slide)
+        return surface
+
+    def _smooth_preview(self, slide):
+        ''' Scale the preview for a slide from the best image at hand,
+        and cache it. '''
+        w = int(PREVIEWW * self._scale)
+        h = int(PREVIEWH * self._scale)
+        pixbuf = slide.get_pixbuf(w, h)
+        if pixbuf.get_width() != w or pixbuf.get_height() != h:
+            pixbuf = pixbuf.scale_simple(w, h, gtk.gdk.INTERP_BILINEAR)
+        surface = pixbuf_to_surface(pixbuf)
+        self._preview_surfaces.put(slide.uid, surface)
+        return surface
+
+    def _refine_preview(self, slide):
+        ''' Idle callback: replace the coarse preview with a smooth one,
+        if the slide is still on show. '''
+        self._refine_id = None
+        if slide.pixbuf is None:
+            return False
+        surface = self._smooth_preview(slide)
+        if not self._thumbnail_mode and self.i < len(self.slides) and \
+                self.slides[self.i] is slide:
+            with self._sprites.batch():
+                self._preview.set_shape(surface)
+        return False
+
+    def _cancel_refine(self):
+        ''' Drop a smooth preview that is no longer wanted. '''
+        if self._refine_id is not None:
+            gobject.source_remove(self._refine_id)
+            self._refine_id = None
 
     def _add_playback_button(self, nick, colors, audio_file):
         ''' Add a toolbar button for this audio recording '''
@@ -533,54 +898,215 @@ class BBoardActivity(activity.Activity):
     def _slides_cb(self, button=None):
         if self._thumbnail_mode:
             self._thumbnail_mode = False
-            self.i = self._current_slide
-            self._show_slide()
+            self._cancel_thumb_fill()
+            # The thumbnails are only hidden, ready for the next
+            # thumbnail view.
+            with self._sprites.batch():
+                self.i = self._current_slide
+                self._show_slide()
 
     def _thumbs_cb(self, button=None):
         ''' Toggle between thumbnail view and slideshow view. '''
         if not self._thumbnail_mode:
-            self._current_slide = self.i
-            self._thumbnail_mode = True
-            self._clear_screen()
+            with self._sprites.batch():
+                self._cancel_prefetch()
+                self._cancel_refine()
+                self._current_slide = self.i
+                self._thumbnail_mode = True
+                self._clear_screen()
+
+                self._prev_button.set_icon('go-previous-inactive')
+                self._next_button.set_icon('go-next-inactive')
+
+                self._layout_thumbs()
+                # Start with the row of the current slide in view.
+                cols, w, h, x_off = self._thumb_layout
+                self._thumb_scroll = 0
+                self._scroll_thumbs((self._current_slide // cols) * h)
+                self.i = 0  # Reset position in slideshow to the beginning
+            # Take the arrow and page keys from the toolbar.
+            self._canvas.grab_focus()
+        return False
 
-            self._prev_button.set_icon('go-previous-inactive')
-            self._next_button.set_icon('go-next-inactive')
+    def _thumb_pixbuf(self, i, w, h, quick=False):
+        ''' Scale the preview (or a blank) to thumbnail size. A quick
+        thumbnail is a coarse scaling of whatever pixbuf is at hand. '''
+        if quick:
+            pixbuf = self.slides[i].pixbuf
+            interp = gtk.gdk.INTERP_NEAREST
+        else:
+            pixbuf = self.slides[i].get_pixbuf(w, h)
+            interp = gtk.gdk.INTERP_BILINEAR
+        if pixbuf is not None:
+            return pixbuf.scale_simple(int(w), int(h), interp)
+        else:
+            return blank_shape(int(w), int(h), self.slides[i].colors)
+
+    def _layout_thumbs(self):
+        ''' Fit the thumbnail grid to the screen width, but with no
+        thumbnail narrower than THUMBW_MIN; rows that do not fit on the
+        screen are reached by scrolling. '''
+        n = max(1, int(ceil(sqrt(len(self.slides)))))
+        cols = max(1, min(n, int(self._width / THUMBW_MIN)))
+        w = int(self._width / cols)
+        h = int(w * 0.75)  # maintain 4:3 aspect ratio
+        x_off = int((self._width - cols * w) / 2)
+        self._thumb_layout = (cols, w, h, x_off)
+
+    def _thumb_xy(self, i):
+        ''' Where thumbnail i is on the screen at the current scroll. '''
+        cols, w, h, x_off = self._thumb_layout
+        return (x_off + (i % cols) * w, (i // cols) * h - self._thumb_scroll)
+
+    def _scroll_thumbs(self, dy):
+        ''' Scroll the thumbnail grid by dy pixels. Only the rows in view,
+        plus THUMB_OVERSCAN rows either side, have sprites; thumbnails
+        that scroll away are recycled for those that scroll in. '''
+        cols, w, h, x_off = self._thumb_layout
+        rows = int(ceil(len(self.slides) / float(cols)))
+        bottom = max(0, rows * h - self._height)
+        self._thumb_scroll = min(max(self._thumb_scroll + int(dy), 0),
+                                 bottom)
+        first = max(0, self._thumb_scroll // h - THUMB_OVERSCAN) * cols
+        last = min(len(self.slides),
+                   ((self._thumb_scroll + self._height) // h + 1 +
+                    THUMB_OVERSCAN) * cols)
+        # Fill in the thumbnails in view before those in the overscan.
+        in_view = max(first, (self._thumb_scroll // h) * cols)
+        out_of_view = max(in_view, min(
+                last, ((self._thumb_scroll + self._height - 1) // h + 1) *
+                cols))
+        self._thumb_queue = []
+        with self._sprites.batch():
+            for i in self._thumbs.keys():
+                if i < first or i >= last:
+                    if self._thumbs[i][0] is self._press:
+                        # Kept until dropped, when it goes home.
+                        self._thumbs[i][1:3] = self._thumb_xy(i)
+                    else:
+                        self._recycle_thumb(i)
+            restack = []
+            for i in range(in_view, out_of_view) + range(first, in_view) + \
+                    range(out_of_view, last):
+                x, y = self._thumb_xy(i)
+                spr = self._show_thumb(i, x, y, w, h)
+                if spr is not None:
+                    restack.append(spr)
+            # Put the new and re-shown thumbnails on top in one go.
+            self._sprites.set_layers(restack, TOP)
+        self._budget.enforce()
+
+    def _recycle_thumb(self, i):
+        ''' Hide a thumbnail, keeping its sprite for another slide. '''
+        thumb = self._thumbs.pop(i)
+        del self._thumb_index[thumb[0]]
+        thumb[0].release()
+        self._spare_thumbs.append(thumb[0])
+
+    def _thumb_key(self, i, w, h):
+        ''' What a thumbnail of slide i at this size looks like; the
+        sprite is only redrawn when this changes. '''
+        slide = self.slides[i]
+        return (slide.uid, slide.version, slide.colors[0], slide.colors[1],
+                w, h)
 
-            n = int(ceil(sqrt(len(self.slides))))
-            if n > 0:
-                w = int(self._width / n)
+    def _show_thumb(self, i, x, y, w, h):
+        ''' Display a preview image and frame as a thumbnail. The sprite
+        already showing slide i is kept, and only redrawn if the slide
+        has changed since it was drawn. Return the sprite if it still
+        needs to be put on the TOP layer, else None. '''
+        self._use_slide(self.slides[i])
+        thumb = self._thumbs.get(i)
+        if thumb is None:
+            if len(self._spare_thumbs) > 0:
+                spr = self._spare_thumbs.pop()
+                spr.move((x, y))
             else:
-                w = self._width
-            h = int(w * 0.75)  # maintain 4:3 aspect ratio
-            x_off = int((self._width - n * w) / 2)
-            x = x_off
-            y = 0
-            self._thumbs = []
-            for i in range(len(self.slides)):
-                self._show_thumb(i, x, y, w, h)
-                x += w
-                if x + w > self._width:
-                    x = x_off
-                    y += h
-            self.i = 0  # Reset position in slideshow to the beginning
+                # Start with just the frame; the thumbnail is drawn below.
+                spr = Sprite(self._sprites, x, y, frame_shape(
+                        int(w), int(h), self.slides[i].colors))
+            thumb = [spr, x, y, i, None, False]
+            self._thumbs[i] = thumb
+            self._thumb_index[spr] = i
+        elif thumb[1:3] != [x, y]:
+            # A thumbnail being dragged goes home when it is dropped.
+            if thumb[0] is not self._press:
+                thumb[0].move((x, y))
+            thumb[1:3] = [x, y]
+        key = self._thumb_key(i, w, h)
+        if thumb[4] != key:
+            # Until the smooth thumbnail is ready, show a quick one (or a
+            # blank in the slide colors, if there is no preview at all).
+            thumb[0].set_image(self._thumb_pixbuf(i, w, h, quick=True))
+            thumb[0].set_image(
+                frame_shape(int(w), int(h), self.slides[i].colors), i=1)
+            thumb[4] = key
+            thumb[5] = self.slides[i].pixbuf is None
+        if not thumb[5]:
+            self._queue_thumb(i)
+        if thumb[0] is self._press:
+            return None  # stay on the DRAG layer
+        if thumb[0].layer != TOP or not self._sprites.in_list(thumb[0]):
+            return thumb[0]
+        return None
+
+    def _queue_thumb(self, i):
+        ''' Scale the preview for thumbnail i when the UI is idle. '''
+        if i not in self._thumb_queue:
+            self._thumb_queue.append(i)
+        if self._thumb_fill_id is None:
+            self._thumb_fill_id = gobject.idle_add(self._fill_next_thumb)
+
+    def _fill_next_thumb(self):
+        ''' Replace the next quick thumbnail with a smooth one. '''
+        while len(self._thumb_queue) > 0:
+            i = self._thumb_queue.pop(0)
+            thumb = self._thumbs.get(i)
+            if thumb is None or thumb[5]:
+                continue
+            cols, w, h, x_off = self._thumb_layout
+            with self._sprites.batch():
+                thumb[0].set_shape(self._thumb_pixbuf(i, w, h))
+            thumb[5] = True
+            return True
+        self._thumb_fill_id = None
+        self._budget.enforce()
         return False
 
-    def _show_thumb(self, i, x, y, w, h):
-        ''' Display a preview image and title as a thumbnail. '''
-        pixbuf = self.slides[i].pixbuf
-        if pixbuf is not None:
-            pixbuf_thumb = pixbuf.scale_simple(
-                int(w), int(h), gtk.gdk.INTERP_TILES)
-        else:
-            pixbuf_thumb = svg_str_to_pixbuf(
-                genblank(int(w), int(h), self.slides[i].colors))
-        # Create a Sprite for this thumbnail
-        self._thumbs.append([Sprite(self._sprites, x, y, pixbuf_thumb),
-                             x, y, i])
-        self._thumbs[i][0].set_image(
-            svg_str_to_pixbuf(svg_rectangle(int(w), int(h),
-                                            self.slides[i].colors)), i=1)
-        self._thumbs[i][0].set_layer(TOP)
+    def _cancel_thumb_fill(self):
+        ''' Stop filling in thumbnails; they are queued again when the
+        thumbnails are next shown. '''
+        if self._thumb_fill_id is not None:
+            gobject.source_remove(self._thumb_fill_id)
+            self._thumb_fill_id = None
+        self._thumb_queue = []
+
+    def _scroll_cb(self, win, event):
+        ''' Scroll the thumbnail grid with the mouse wheel. '''
+        if not self._thumbnail_mode or self._press is not None:
+            return False
+        h = self._thumb_layout[2]
+        if event.direction == gtk.gdk.SCROLL_UP:
+            self._scroll_thumbs(-h / 2)
+        elif event.direction == gtk.gdk.SCROLL_DOWN:
+            self._scroll_thumbs(h / 2)
+        return True
+
+    def _key_press_cb(self, win, event):
+        ''' Scroll the thumbnail grid by a row with the arrow keys, or by
+        a screenful with the page keys. '''
+        if not self._thumbnail_mode or self._press is not None:
+            return False
+        h = self._thumb_layout[2]
+        page = max(h, (self._height // h - 1) * h)
+        steps = {'Up': -h, 'Down': h, 'Page_Up': -page, 'Page_Down': page}
+        k = gtk.gdk.keyval_name(event.keyval)
+        if k is not None and k.startswith('KP_'):
+            k = k[3:]
+        if k not in steps:
+            return False
+        self._scroll_thumbs(steps[k])
+        return True
 
     def _expose_cb(self, win, event):
         ''' Callback to handle window expose events '''
@@ -594,12 +1120,12 @@ class BBoardActivity(activity.Activity):
         cr = self.canvas.window.cairo_create()
 
         # Restrict Cairo to the exposed area; avoid extra work
-        cr.rectangle(event.area.x, event.area.y,
-                event.area.width, event.area.height)
+        for rect in event.region.get_rectangles():
+            cr.rectangle(rect.x, rect.y, rect.width, rect.height)
         cr.clip()
 
-        # Refresh sprite list
-        self._sprites.redraw_sprites(cr=cr)
+        # Refresh only those sprites that were damaged
+        self._sprites.redraw_sprites(event.region, cr=cr)
 
     def write_file(self, file_path):
         ''' Clean up '''
@@ -613,24 +1139,13 @@ class BBoardActivity(activity.Activity):
         ''' Hide the Sugar toolbars. '''
         self.fullscreen()
 
-    def invalt(self, x, y, w, h):
-        ''' Mark a region for refresh '''
-        self._canvas.window.invalidate_rect(
-            gtk.gdk.Rectangle(int(x), int(y), int(w), int(h)), False)
-
     def _spr_to_thumb(self, spr):
         ''' Find which entry in the thumbnails table matches spr. '''
-        for i, thumb in enumerate(self._thumbs):
-            if spr == thumb[0]:
-                return i
-        return -1
+        return self._thumb_index.get(spr, -1)
 
     def _spr_is_thumbnail(self, spr):
         ''' Does spr match an entry in the thumbnails table? '''
-        if self._spr_to_thumb(spr) == -1:
-            return False
-        else:
-            return True
+        return spr in self._thumb_index
 
     def _button_press_cb(self, win, event):
         ''' The mouse button was pressed. Is it on a thumbnail sprite? '''
@@ -639,6 +1154,7 @@ class BBoardActivity(activity.Activity):
 
         self._dragpos = [x, y]
         self._total_drag = [0, 0]
+        self._drag_stats = {'events': 0, 'merged': 0, 'frames': 0}
 
         spr = self._sprites.find_sprite((x, y))
         self._press = None
@@ -660,25 +1176,97 @@ class BBoardActivity(activity.Activity):
             self._dragpos = [0, 0]
             return False
         win.grab_focus()
-        x, y = map(int, event.get_coords())
+        if event.is_hint:
+            # Asking for the pointer position requests the next event.
+            x, y, state = event.window.get_pointer()
+        else:
+            x, y = map(int, event.get_coords())
+        # Only remember where the pointer is; the sprite is moved at
+        # most once per frame, to wherever the pointer is by then.
+        self._drag_to = [x, y]
+        self._drag_stats['events'] += 1
+        if self._drag_frame_id is None:
+            self._drag_frame_id = gobject.timeout_add(FRAME_INTERVAL,
+                                                      self._drag_frame)
+        else:
+            self._drag_stats['merged'] += 1
+        return False
+
+    def _drag_frame(self):
+        ''' Move the dragged sprite to the latest pointer position. '''
+        self._drag_frame_id = None
+        if self._press is None or self._drag_to is None:
+            return False
+        x, y = self._drag_to
+        self._drag_to = None
         dx = x - self._dragpos[0]
         dy = y - self._dragpos[1]
-        spr.move_relative([dx, dy])
-        # Also move the star
+        self._press.move_relative([dx, dy])
         self._dragpos = [x, y]
         self._total_drag[0] += dx
         self._total_drag[1] += dy
+        self._drag_stats['frames'] += 1
+        if self._autoscroll_id is None and self._autoscroll_step() != 0:
+            self._autoscroll_id = gobject.timeout_add(FRAME_INTERVAL,
+                                                      self._autoscroll)
         return False
 
+    def _autoscroll_step(self):
+        ''' How far to scroll the thumbnails each frame while one is
+        dragged near the top or bottom edge of the canvas '''
+        edge = int(AUTOSCROLL_EDGE * self._scale)
+        y = self._dragpos[1]
+        if y < edge:
+            return -int(AUTOSCROLL_STEP * self._scale)
+        elif y > self._canvas.get_allocation().height - edge:
+            return int(AUTOSCROLL_STEP * self._scale)
+        return 0
+
+    def _autoscroll(self):
+        ''' Timeout callback: scroll the thumbnails while one is dragged
+        near an edge, even if the pointer stays still. '''
+        dy = 0
+        if self._press is not None:
+            dy = self._autoscroll_step()
+        if dy != 0:
+            scroll = self._thumb_scroll
+            self._scroll_thumbs(dy)
+            if self._thumb_scroll != scroll:
+                return True
+        # Started again by the next drag frame near an edge
+        self._autoscroll_id = None
+        return False
+
+    def _cancel_drag_frame(self):
+        ''' Drop any pending drag update. '''
+        if self._drag_frame_id is not None:
+            gobject.source_remove(self._drag_frame_id)
+            self._drag_frame_id = None
+        self._drag_to = None
+        self._cancel_autoscroll()
+
+    def _cancel_autoscroll(self):
+        ''' Stop scrolling the thumbnails for a drag. '''
+        if self._autoscroll_id is not None:
+            gobject.source_remove(self._autoscroll_id)
+            self._autoscroll_id = None
+
     def _button_release_cb(self, win, event):
         ''' Button event is used to swap slides or goto next slide. '''
         win.grab_focus()
+        if self._drag_frame_id is not None:
+            # Catch up with the pointer before dropping.
+            gobject.source_remove(self._drag_frame_id)
+            self._drag_frame()
+        self._cancel_autoscroll()
         self._dragpos = [0, 0]
         x, y = map(int, event.get_coords())
 
         if self._thumbnail_mode:
             if self._press is None:
                 return
+            _logger.debug('drag: %(events)d motion events (%(merged)d merged) '
+                          'in %(frames)d frames' % self._drag_stats)
             # Drop the dragged thumbnail below the other thumbnails so
             # that you can find the thumbnail beneath it.
             self._press.set_layer(UNDRAG)
@@ -692,6 +1280,13 @@ class BBoardActivity(activity.Activity):
                     j = self._spr_to_thumb(self._release)
                     self._thumbs[i][0] = self._release
                     self._thumbs[j][0] = self._press
+                    self._thumbs[i][4:], self._thumbs[j][4:] = \
+                        self._thumbs[j][4:], self._thumbs[i][4:]
+                    self._thumb_index[self._release] = i
+                    self._thumb_index[self._press] = j
+                    for k in [i, j]:
+                        if not self._thumbs[k][5]:
+                            self._queue_thumb(k)
                     tmp = self.slides[i]
                     self.slides[i] = self.slides[j]
                     self.slides[j] = tmp
@@ -701,6 +1296,8 @@ class BBoardActivity(activity.Activity):
             self._press.set_layer(TOP)
             self._press = None
             self._release = None
+            # Recycle the dropped thumbnail if it was scrolled away.
+            self._scroll_thumbs(0)
         else:
             self._next_cb()
         return False
@@ -836,8 +1433,10 @@ class BBoardActivity(activity.Activity):
     def _dump(self, slide):
         ''' Dump data for sharing.'''
         _logger.debug('dumping %s' % (slide.uid))
+        self._decode_slide(slide)
         data = [slide.uid, slide.colors, slide.title,
                 pixbuf_to_base64(activity, slide.pixbuf), slide.desc]
+        self._budget.enforce()
         return self._data_dumper(data)
 
     def _data_dumper(self, data):
@@ -969,6 +1568,7 @@ class BBoardActivity(activity.Activity):
         if text[0] == 's':  # shared journal objects
             e, data = text.split(':')
             self._load(data)
+            self._budget.enforce()
         elif text[0] == 'j':  # Someone new has joined
             e, buddy = text.split(':')
             _logger.debug('%s has joined' % (buddy))
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2012 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+
+import gtk
+import os
+import mmap
+import struct
+from collections import OrderedDict
+from hashlib import md5
+
+import logging
+_logger = logging.getLogger('bboard-activity')
+
+# Each cache file is a small header followed by the raw pixel rows of
+# the pixbuf, so an entry can be mapped and handed straight to gdk.
+_MAGIC = 'BBPC'
+_HEADER = struct.Struct('<4sIIIB')
+_SUFFIX = '.pbc'
+
+
+class LRUCache:
+    ''' A bounded mapping that forgets the least-recently used entries.
+    It may be bounded by number of entries, by total size in bytes (as
+    reported by the sizeof function), or both. '''
+
+    def __init__(self, max_entries=32, max_bytes=None, sizeof=None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        ''' Return the value for key, marking it as most recently used '''
+        if key not in self._entries:
+            return default
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        ''' Add or replace an entry, evicting the oldest if over budget '''
+        self.remove(key)
+        self._entries[key] = value
+        if self._sizeof is not None:
+            self._sizes[key] = self._sizeof(value)
+            self.bytes += self._sizes[key]
+        while len(self._entries) > 1 and self._over_budget():
+            self.remove(self._entries.iterkeys().next())
+
+    def _over_budget(self):
+        if self._max_entries is not None and \
+                len(self._entries) > self._max_entries:
+            return True
+        if self._max_bytes is not None and self.bytes > self._max_bytes:
+            return True
+        return False
+
+    def keys(self):
+        ''' The keys, least-recently used first '''
+        return self._entries.keys()
+
+    def shrink(self, nbytes):
+        ''' Forget the least-recently used entries until nbytes have
+        been freed, returning the number of bytes freed '''
+        freed = 0
+        while freed < nbytes and len(self._entries) > 0:
+            key = self._entries.iterkeys().next()
+            freed += self._sizes.get(key, 0)
+            self.remove(key)
+        return freed
+
+    def remove(self, key):
+        ''' Forget an entry '''
+        if key in self._entries:
+            del self._entries[key]
+            if key in self._sizes:
+                self.bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        ''' Forget all entries '''
+        self._entries.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+
+def surface_size(surface):
+    ''' How many bytes does an image surface hold? '''
+    return surface.get_stride() * surface.get_height()
+
+
+def pixbuf_size(pixbuf):
+    ''' How many bytes does a pixbuf hold? '''
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class PreviewCache:
+    ''' An on-disk cache of decoded previews, keyed by Journal object
+    id and modification time, and bounded by total size. '''
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._entries = {}  # file name -> [size, last use]
+        self._pinned = set()  # file names that must not be evicted
+        self._bytes = 0
+        if not os.path.exists(self._path):
+            try:
+                os.makedirs(self._path)
+            except OSError, e:
+                _logger.error('Could not create preview cache: %s' % (e))
+                return
+        for name in os.listdir(self._path):
+            if not name.endswith(_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self._path, name))
+            except OSError:
+                continue
+            self._entries[name] = [st.st_size, st.st_mtime]
+            self._bytes += st.st_size
+
+    def _name(self, uid, mtime):
+        ''' The file name for an object id at a given modification time '''
+        return md5('%s:%s' % (uid, mtime)).hexdigest() + _SUFFIX
+
+    def get(self, uid, mtime):
+        ''' Return the cached pixbuf or None '''
+        name = self._name(uid, mtime)
+        if name not in self._entries:
+            return None
+        path = os.path.join(self._path, name)
+        try:
+            fd = open(path, 'rb')
+            try:
+                data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fd.close()
+            try:
+                magic, w, h, rowstride, has_alpha = \
+                    _HEADER.unpack(data[:_HEADER.size])
+                if magic != _MAGIC or \
+                        len(data) < _HEADER.size + rowstride * h:
+                    raise ValueError('bad cache entry')
+                pixels = data[_HEADER.size:_HEADER.size + rowstride * h]
+            finally:
+                data.close()
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, struct.error), e:
+            _logger.debug('Dropping preview cache entry %s: %s' % (name, e))
+            self._remove(name)
+            return None
+        self._entries[name][1] = os.path.getmtime(path)
+        return gtk.gdk.pixbuf_new_from_data(
+            pixels, gtk.gdk.COLORSPACE_RGB, bool(has_alpha), 8, w, h,
+            rowstride)
+
+    def put(self, uid, mtime, pixbuf, pin=False):
+        ''' Store a pixbuf and evict the oldest entries if over budget.
+        A pinned entry is kept until unpinned. Return whether the pixbuf
+        was stored. '''
+        if pixbuf is None:
+            return False
+        name = self._name(uid, mtime)
+        path = os.path.join(self._path, name)
+        tmp_path = path + '.tmp'
+        h = pixbuf.get_height()
+        rowstride = pixbuf.get_rowstride()
+        try:
+            fd = open(tmp_path, 'wb')
+            try:
+                fd.write(_HEADER.pack(_MAGIC, pixbuf.get_width(), h,
+                                      rowstride, int(pixbuf.get_has_alpha())))
+                fd.write(pixbuf.get_pixels()[:rowstride * h])
+            finally:
+                fd.close()
+            os.rename(tmp_path, path)
+            st = os.stat(path)
+        except (IOError, OSError), e:
+            _logger.error('Could not write preview cache entry: %s' % (e))
+            return False
+        if name in self._entries:
+            self._bytes -= self._entries[name][0]
+        self._entries[name] = [st.st_size, st.st_mtime]
+        self._bytes += st.st_size
+        if pin:
+            self._pinned.add(name)
+        self._trim()
+        if self._bytes > self._max_bytes:
+            # Only pinned entries are left: there is no room for this one.
+            self._remove(name)
+        return name in self._entries
+
+    def unpin(self, uid, mtime):
+        ''' Allow an entry to be evicted again '''
+        self._pinned.discard(self._name(uid, mtime))
+
+    def _trim(self):
+        ''' Remove least-recently used, unpinned entries until within
+        budget '''
+        if self._bytes <= self._max_bytes:
+            return
+        names = sorted([name for name in self._entries.keys()
+                        if name not in self._pinned],
+                       key=lambda name: self._entries[name][1])
+        for name in names:
+            if self._bytes <= self._max_bytes:
+                break
+            self._remove(name)
+
+    def _remove(self, name):
+        ''' Forget an entry and delete its file '''
+        self._pinned.discard(name)
+        if name in self._entries:
+            self._bytes -= self._entries.pop(name)[0]
+        try:
+            os.remove(os.path.join(self._path, name))
+        except OSError:
+            pass
+
+
+class MemoryBudget:
+    ''' Keeps the memory held by a number of caches within one budget.
+    Each cache is tracked by name, with a function returning how many
+    bytes it holds and, if it can give memory back, a function
+    shrink(nbytes) that drops its least-recently used, off-screen data
+    (to be re-created on demand) and returns the bytes freed. When over
+    budget, the caches are shrunk in the order they were added. '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.freed = 0  # total bytes given back so far
+        self._sizes = OrderedDict()
+        self._shrinks = {}
+
+    def track(self, name, size, shrink=None):
+        ''' Add a cache to the budget '''
+        self._sizes[name] = size
+        if shrink is not None:
+            self._shrinks[name] = shrink
+
+    def usage(self):
+        ''' Return the bytes held by each cache, by name '''
+        return OrderedDict([(name, size())
+                            for name, size in self._sizes.iteritems()])
+
+    def total(self):
+        ''' Return the bytes held by all of the caches '''
+        return sum(self.usage().values())
+
+    def report(self):
+        ''' Describe the current usage, e.g. for the log '''
+        usage = self.usage()
+        return '%dK of %dK (%s)' % (
+            sum(usage.values()) / 1024, self.max_bytes / 1024,
+            ', '.join(['%s %dK' % (name, size / 1024)
+                       for name, size in usage.iteritems()]))
+
+    def enforce(self):
+        ''' Shrink the caches until within budget, returning the number
+        of bytes freed '''
+        freed = 0
+        for name in self._sizes:
+            over = self.total() - self.max_bytes
+            if over <= 0:
+                break
+            if name in self._shrinks:
+                freed += self._shrinks[name](over)
+        if freed > 0:
+            self.freed += freed
+            _logger.debug('Freed %dK: %s' % (freed / 1024, self.report()))
+        return freed
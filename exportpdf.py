@@ -66,10 +66,13 @@ def save_pdf(activity,  nicks, description=None):
 
         w = 300
         h = 225
-        if slide.pixbuf is not None:
+        pixbuf = slide.get_pixbuf(w, h)
+        if pixbuf is not None:
+            if pixbuf.get_width() != w or pixbuf.get_height() != h:
+                pixbuf = pixbuf.scale_simple(w, h, gtk.gdk.INTERP_BILINEAR)
             cr.save()
             cr = gtk.gdk.CairoContext(cr)
-            cr.set_source_pixbuf(slide.pixbuf, LEFT_MARGIN, TOP_MARGIN + 150)
+            cr.set_source_pixbuf(pixbuf, LEFT_MARGIN, TOP_MARGIN + 150)
             cr.rectangle(LEFT_MARGIN, TOP_MARGIN + 150, w, h)
             cr.fill()
             cr.restore()
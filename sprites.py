@@ -27,10 +27,12 @@ sprites.py is a simple sprites library for managing graphics objects,
 'sprites', on a gtk.DrawingArea. It manages multiple sprites with
 methods such as move, hide, set_layer, etc.
 
-There are two classes:
+There are three classes:
 
 class Sprites maintains a collection of sprites
 class Sprite manages individual sprites within the collection.
+class Shape is a procedural image (solid fills and frames) that can be
+      used in place of a pixbuf; it is painted directly at draw time.
 
 Example usage:
         # Import the classes into your program.
@@ -82,15 +84,103 @@ import gtk
 import pango
 import pangocairo
 import cairo
+from math import pi
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import OrderedDict
+
+COLORTABLE = {'black': '#000000', 'white': '#FFFFFF',
+              'red': '#FF0000', 'yellow': '#FFFF00',
+              'green': '#00FF00', 'cyan': '#00FFFF',
+              'blue': '#0000FF', 'purple': '#FF00FF',
+              'gray': '#808080'}
+
+
+def _color_to_rgb(rgb):
+    ''' Convert from a color name or '#RRGGBB' to floats '''
+    if rgb.lower() in COLORTABLE:
+        rgb = COLORTABLE[rgb.lower()]
+    return (int('0x' + rgb[1:3], 16) / 256.,
+            int('0x' + rgb[3:5], 16) / 256.,
+            int('0x' + rgb[5:7], 16) / 256.)
+
+
+class SurfacePool:
+    ''' A pool of image surfaces, keyed by format and size, that are
+    recycled rather than reallocated. At most max_per_size surfaces of
+    any one size, and max_bytes in total, are kept. '''
+
+    def __init__(self, max_per_size=8, max_bytes=8 * 1024 * 1024):
+        self.max_per_size = max_per_size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._free = {}  # (format, width, height) -> list of surfaces
+
+    def get(self, format, width, height):
+        ''' Return a surface (with undefined contents) from the pool '''
+        key = (format, width, height)
+        if key in self._free and len(self._free[key]) > 0:
+            surface = self._free[key].pop()
+            self.bytes -= surface.get_stride() * height
+            self.hits += 1
+            return surface
+        self.misses += 1
+        return cairo.ImageSurface(format, width, height)
+
+    def release(self, surface):
+        ''' Return a surface that is no longer in use to the pool '''
+        height = surface.get_height()
+        size = surface.get_stride() * height
+        key = (surface.get_format(), surface.get_width(), height)
+        if key not in self._free:
+            self._free[key] = []
+        if len(self._free[key]) >= self.max_per_size or \
+                self.bytes + size > self.max_bytes:
+            return
+        self._free[key].append(surface)
+        self.bytes += size
+
+    def clear(self):
+        ''' Drop all pooled surfaces '''
+        self._free = {}
+        self.bytes = 0
+
+    def shrink(self, nbytes):
+        ''' Drop pooled surfaces until nbytes have been freed, returning
+        the number of bytes freed '''
+        freed = 0
+        for key in self._free.keys():
+            while freed < nbytes and len(self._free[key]) > 0:
+                size = self._free[key].pop().get_stride() * key[2]
+                self.bytes -= size
+                freed += size
+        return freed
+
 
 class Sprites:
     ''' A class for the list of sprites and everything they share in common '''
 
+    # Size of the cells of the grid used to index sprites by position
+    CELL_SIZE = 128
+
     def __init__(self, widget):
         ''' Initialize an empty array of sprites '''
         self.widget = widget
         self.list = []
         self.cr = None
+        self._keys = []  # (layer, seq) of each sprite in list, in order
+        self._members = set()
+        self._grid = {}  # (column, row) -> set of sprites in that cell
+        self._seq = 0  # stamp recording the order sprites were placed
+        self.pool = SurfacePool()
+        self._dynamic_layer = None  # no backing store
+        self._backing = None
+        self._backing_size = (0, 0)
+        self._backing_damage = gtk.gdk.Region()
+        self._batch_depth = 0
+        self._pending = gtk.gdk.Region()
 
     def set_cairo_context(self, cr):
         ''' Cairo context may be set or reset after __init__ '''
@@ -108,34 +198,176 @@ class Sprites:
         return(len(self.list))
 
     def append_to_list(self, spr):
-        ''' Append a new sprite to the end of the list. '''
-        self.list.append(spr)
+        ''' Add a sprite to the list, above all others in its layer. '''
+        if spr in self._members:
+            return
+        self._seq += 1
+        spr._key = (spr.layer, self._seq)
+        i = bisect_left(self._keys, spr._key)
+        self.list.insert(i, spr)
+        self._keys.insert(i, spr._key)
+        self._members.add(spr)
+        self._index_add(spr)
+        self.damage_static(spr)
 
     def insert_in_list(self, spr, i):
-        ''' Insert a sprite at position i. '''
-        if i < 0:
-            self.list.insert(0, spr)
-        elif i > len(self.list) - 1:
-            self.list.append(spr)
-        else:
-            self.list.insert(i, spr)
+        ''' Add a sprite to the list. The list is kept sorted by layer,
+        so the position is determined by the sprite's layer, not i. '''
+        self.append_to_list(spr)
 
     def remove_from_list(self, spr):
         ''' Remove a sprite from the list. '''
-        if spr in self.list:
-            self.list.remove(spr)
+        if spr in self._members:
+            self.damage_static(spr)
+            i = bisect_left(self._keys, spr._key)
+            del self.list[i]
+            del self._keys[i]
+            self._members.discard(spr)
+            self._index_remove(spr)
+
+    def set_backing_store(self, dynamic_layer):
+        ''' Keep the sprites below dynamic_layer composited in a backing
+        surface, which is only repainted where those sprites change, so
+        an expose is a single blit plus the sprites at or above
+        dynamic_layer. Pass None to turn the backing store off. '''
+        self._dynamic_layer = dynamic_layer
+        self._backing = None
+        self._backing_damage = gtk.gdk.Region()
+
+    def _is_static(self, spr):
+        ''' Is the sprite composited in the backing store? '''
+        return self._dynamic_layer is not None and \
+            spr.layer < self._dynamic_layer and spr in self._members
+
+    def damage_static(self, spr):
+        ''' Mark the area of a static sprite as stale in the backing
+        store (called before and after it changes). '''
+        if self._is_static(spr):
+            self._backing_damage.union_with_rect(spr.rect)
+
+    def invalidate(self, x, y, width, height):
+        ''' Ask gtk to repaint an area; inside a batch, the area is
+        accumulated and repainted when the batch ends. '''
+        if width <= 0 or height <= 0:
+            return
+        if self._batch_depth > 0:
+            self._pending.union_with_rect(
+                gtk.gdk.Rectangle(int(x), int(y), int(width), int(height)))
+        else:
+            self.widget.queue_draw_area(int(x), int(y), int(width),
+                                        int(height))
+
+    @contextmanager
+    def batch(self):
+        ''' Collect the invalidations made by a series of changes and
+        flush them as a single region:
+
+            with sprites.batch():
+                spr1.hide()
+                spr2.set_layer(100)
+        '''
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._flush()
+
+    def _flush(self):
+        ''' Invalidate the area accumulated during a batch '''
+        pending = self._pending
+        self._pending = gtk.gdk.Region()
+        if pending.empty():
+            return
+        if self.widget.window is not None:
+            self.widget.window.invalidate_region(pending, False)
+        else:
+            for rect in pending.get_rectangles():
+                self.widget.queue_draw_area(rect.x, rect.y, rect.width,
+                                            rect.height)
+
+    def in_list(self, spr):
+        ''' Is the sprite in the list (i.e., not hidden)? '''
+        return spr in self._members
+
+    def get_bytes(self):
+        ''' How many bytes do the surfaces of the sprites on show, and
+        the backing store, hold? '''
+        total = sum([spr.get_bytes() for spr in self.list])
+        if self._backing is not None:
+            total += self._backing.get_stride() * self._backing.get_height()
+        return total
+
+    def set_layers(self, sprites, layer):
+        ''' Move a batch of sprites to a layer, sorting the list once
+        rather than inserting the sprites one at a time. '''
+        batch = set(sprites)
+        if len(batch) == 0:
+            return
+        for spr in batch & self._members:
+            self.damage_static(spr)
+            self._index_remove(spr)
+        self._members -= batch
+        self.list = [spr for spr in self.list if spr not in batch]
+        for spr in sprites:
+            if spr in self._members:
+                continue  # a duplicate entry
+            spr.layer = layer
+            self._seq += 1
+            spr._key = (layer, self._seq)
+            self.list.append(spr)
+            self._members.add(spr)
+            self._index_add(spr)
+            self.damage_static(spr)
+        self.list.sort(key=lambda spr: spr._key)
+        self._keys = [spr._key for spr in self.list]
+        for spr in batch:
+            spr.inval()
+
+    def _index_add(self, spr):
+        ''' Enter a sprite in every grid cell that its rect touches. '''
+        x0 = spr.rect.x // self.CELL_SIZE
+        x1 = (spr.rect.x + spr.rect.width) // self.CELL_SIZE
+        y0 = spr.rect.y // self.CELL_SIZE
+        y1 = (spr.rect.y + spr.rect.height) // self.CELL_SIZE
+        spr._cells = [(col, row) for col in range(x0, x1 + 1)
+                      for row in range(y0, y1 + 1)]
+        for cell in spr._cells:
+            if cell not in self._grid:
+                self._grid[cell] = set()
+            self._grid[cell].add(spr)
+
+    def _index_remove(self, spr):
+        ''' Remove a sprite from the grid. '''
+        for cell in spr._cells:
+            self._grid[cell].discard(spr)
+            if len(self._grid[cell]) == 0:
+                del self._grid[cell]
+        spr._cells = []
+
+    def update_index(self, spr):
+        ''' Re-index a sprite whose position or size has changed. '''
+        if spr not in self._members:
+            return
+        self._index_remove(spr)
+        self._index_add(spr)
 
     def find_sprite(self, pos):
         ''' Search based on (x, y) position. Return the 'top/first' one. '''
-        list = self.list[:]
-        list.reverse()
-        for spr in list:
-            if spr.hit(pos):
-                return spr
-        return None
+        # Only the sprites indexed in the grid cell under pos are
+        # candidates; of those that are hit, the one with the highest
+        # (layer, placement) key, i.e. the last in the list, is on top.
+        cell = (int(pos[0]) // self.CELL_SIZE, int(pos[1]) // self.CELL_SIZE)
+        top = None
+        for spr in self._grid.get(cell, ()):
+            if spr.hit(pos) and (top is None or spr._key > top._key):
+                top = spr
+        return top
 
     def redraw_sprites(self, area=None, cr=None):
-        ''' Redraw the sprites that intersect area. '''
+        ''' Redraw the sprites that intersect area, which may be a
+        gtk.gdk.Rectangle or a (multi-rectangle) gtk.gdk.Region '''
         # I think I need to do this to save Cairo some work
         if cr is None:
             cr = self.cr
@@ -144,13 +376,243 @@ class Sprites:
         if cr is None:
             print 'sprites.redraw_sprites: no Cairo context'
             return
-        for spr in self.list:
-            if area == None:
+        if isinstance(area, gtk.gdk.Rectangle):
+            area = gtk.gdk.region_rectangle(area)
+        if area is not None and area.empty():
+            return
+        if self._dynamic_layer is None:
+            self._draw_sprites(cr, self._visible_sprites(area, self.list))
+            return
+        # Split the list into the static sprites, held in the backing
+        # store, and the dynamic ones drawn over it.
+        split = bisect_left(self._keys, (self._dynamic_layer,))
+        self._update_backing(cr, self.list[:split])
+        cr.save()
+        if area is not None:
+            for rect in area.get_rectangles():
+                cr.rectangle(rect.x, rect.y, rect.width, rect.height)
+            cr.clip()
+        cr.set_source_surface(self._backing, 0, 0)
+        cr.paint()
+        cr.restore()
+        self._draw_sprites(cr, self._visible_sprites(area,
+                                                     self.list[split:]))
+
+    def _draw_sprites(self, cr, visible):
+        ''' Draw (sprite, clip region) pairs, as planned by
+        _visible_sprites '''
+        for spr, clip in visible:
+            if clip is None:
+                spr.draw(cr=cr)
+            else:
+                cr.save()
+                for rect in clip.get_rectangles():
+                    cr.rectangle(rect.x, rect.y, rect.width, rect.height)
+                cr.clip()
                 spr.draw(cr=cr)
+                cr.restore()
+
+    def _update_backing(self, cr, static):
+        ''' Repaint the stale parts of the backing store '''
+        width = self.widget.allocation.width
+        height = self.widget.allocation.height
+        if self._backing is None or \
+                self._backing_size != (width, height):
+            self._backing = cr.get_target().create_similar(
+                cairo.CONTENT_COLOR_ALPHA, width, height)
+            self._backing_size = (width, height)
+            self._backing_damage = gtk.gdk.region_rectangle(
+                gtk.gdk.Rectangle(0, 0, width, height))
+        if self._backing_damage.empty():
+            return
+        damage = self._backing_damage
+        self._backing_damage = gtk.gdk.Region()
+        bcr = gtk.gdk.CairoContext(cairo.Context(self._backing))
+        for rect in damage.get_rectangles():
+            bcr.rectangle(rect.x, rect.y, rect.width, rect.height)
+        bcr.clip()
+        bcr.set_operator(cairo.OPERATOR_CLEAR)
+        bcr.paint()
+        bcr.set_operator(cairo.OPERATOR_OVER)
+        self._draw_sprites(bcr, self._visible_sprites(damage, static))
+
+    def _visible_sprites(self, area, sprites):
+        ''' Return, bottom to top, those of sprites (a bottom-to-top
+        list) with some part visible in area (a gtk.gdk.Region, or None
+        for everywhere), each with the region it should be clipped to
+        (or None if it is not occluded) '''
+        # Walk down from the top, accumulating the area covered by
+        # opaque sprites; anything entirely beneath it is skipped.
+        covered = gtk.gdk.Region()
+        visible = []
+        for spr in reversed(sprites):
+            exposed = gtk.gdk.region_rectangle(spr.rect)
+            if area is not None:
+                exposed.intersect(area)
+            if exposed.empty():
+                continue
+            overlap = covered.rect_in(spr.rect)
+            if overlap == gtk.gdk.OVERLAP_RECTANGLE_OUT:
+                visible.append((spr, None))
             else:
-                intersection = spr.rect.intersect(area)
-                if intersection.width > 0 or intersection.height > 0:
-                    spr.draw(cr=cr)
+                exposed.subtract(covered)
+                if exposed.empty():
+                    continue
+                visible.append((spr, exposed))
+            if spr.is_opaque():
+                covered.union_with_rect(spr.rect)
+        visible.reverse()
+        return visible
+
+
+_ALIGNMENTS = {'left': pango.ALIGN_LEFT, 'center': pango.ALIGN_CENTER,
+               'right': pango.ALIGN_RIGHT}
+
+_scratch = []
+
+
+def _scratch_surface():
+    ''' A 1x1 surface that provides a context for measuring text '''
+    if len(_scratch) == 0:
+        _scratch.append(cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+    return _scratch[0]
+
+
+# Fitted (text, font size) for each (text, font, size, box, mode),
+# least-recently used first
+_fitted = OrderedDict()
+_FITTED_MAX = 256
+
+
+def fit_text(text, font, size, width, height, rescale=True, wrap=False):
+    ''' Fit text into a box, returning the text to show and the font
+    size (in points) to show it at.
+
+    Without wrapping, text that is too wide is either scaled down
+    (rescale) or has its beginning replaced by an ellipsis; the cut
+    point is found by binary search. With wrapping, the text is
+    broken into lines of at most width pixels and, if rescale is set,
+    the largest font size at which the lines fit in height is found by
+    binary search. Results are memoized. '''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    key = (text, font, size, width, height, rescale, wrap)
+    fitted = _fitted.pop(key, None)
+    if fitted is not None:
+        _fitted[key] = fitted
+        return fitted
+
+    fd = pango.FontDescription(font)
+    pl = pangocairo.CairoContext(
+        cairo.Context(_scratch_surface())).create_layout()
+    if wrap:
+        pl.set_width(int(width * pango.SCALE))
+        pl.set_wrap(pango.WRAP_WORD_CHAR)
+
+    def measure(text, units):
+        pl.set_text(text)
+        fd.set_size(int(units))
+        pl.set_font_description(fd)
+        w, h = pl.get_size()
+        return (w / pango.SCALE, h / pango.SCALE)
+
+    units = int(size * pango.SCALE)
+    w, h = measure(text, units)
+    if wrap:
+        if rescale and h > height:
+            # Largest size (in pango units) whose wrapped text fits
+            lo, hi = 1, units - 1
+            while lo < hi:
+                mid = (lo + hi + 1) / 2
+                if measure(text, mid)[1] <= height:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            size = float(lo) / pango.SCALE
+    elif w > width:
+        if rescale:
+            size = float(size) * width / w
+        else:
+            # Longest tail of the text that fits after an ellipsis
+            lo, hi = 1, len(text) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) / 2
+                if measure(u'\u2026' + text[len(text) - mid:], units)[0] \
+                        <= width:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            text = u'\u2026' + text[len(text) - max(lo, 1):]
+    fitted = (text, size)
+    _fitted[key] = fitted
+    if len(_fitted) > _FITTED_MAX:
+        _fitted.popitem(last=False)
+    return fitted
+
+
+def _label_text(label):
+    ''' The text to show for a label '''
+    if type(label) is str or type(label) is unicode:
+        # pango doesn't like nulls
+        return label.replace("\0", " ")
+    return str(label)
+
+
+class Shape:
+    ''' A procedural image: filled and framed rectangles that are
+    painted directly with Cairo when the sprite is drawn '''
+
+    def __init__(self, width, height):
+        ''' Initialize an empty shape of a given size '''
+        self.width = int(width)
+        self.height = int(height)
+        self._rects = []
+
+    def get_size(self):
+        ''' Return the size of the shape '''
+        return (self.width, self.height)
+
+    def is_opaque(self):
+        ''' Does a solid, square-cornered fill cover the whole shape? '''
+        for x, y, w, h, r, fill, stroke, stroke_width in self._rects:
+            if fill is not None and r == 0 and x <= 0 and y <= 0 and \
+                    x + w >= self.width and y + h >= self.height:
+                return True
+        return False
+
+    def add_rect(self, x, y, w, h, radius=0, fill=None, stroke=None,
+                 stroke_width=1.0):
+        ''' Add a (rounded) rectangle; fill and stroke are colors or None '''
+        if fill is not None:
+            fill = _color_to_rgb(fill)
+        if stroke is not None:
+            stroke = _color_to_rgb(stroke)
+        self._rects.append((x, y, w, h, radius, fill, stroke, stroke_width))
+
+    def draw(self, cr, x, y):
+        ''' Paint the shape with its upper-left corner at (x, y) '''
+        for dx, dy, w, h, r, fill, stroke, stroke_width in self._rects:
+            left = x + dx
+            top = y + dy
+            if r > 0:
+                cr.new_path()
+                cr.arc(left + w - r, top + r, r, -pi / 2, 0)
+                cr.arc(left + w - r, top + h - r, r, 0, pi / 2)
+                cr.arc(left + r, top + h - r, r, pi / 2, pi)
+                cr.arc(left + r, top + r, r, pi, 3 * pi / 2)
+                cr.close_path()
+            else:
+                cr.rectangle(left, top, w, h)
+            if fill is not None:
+                cr.set_source_rgb(fill[0], fill[1], fill[2])
+                if stroke is not None:
+                    cr.fill_preserve()
+                else:
+                    cr.fill()
+            if stroke is not None:
+                cr.set_source_rgb(stroke[0], stroke[1], stroke[2])
+                cr.set_line_width(stroke_width)
+                cr.stroke()
 
 
 class Sprite:
@@ -163,6 +625,7 @@ class Sprite:
         self.rect = gtk.gdk.Rectangle(int(x), int(y), 0, 0)
         self._scale = [12]
         self._rescale = [True]
+        self._wrap = [False]
         self._horiz_align = ["center"]
         self._vert_align = ["middle"]
         self._fd = None
@@ -172,10 +635,16 @@ class Sprite:
         self._margins = [0, 0, 0, 0]
         self.layer = 100
         self.labels = []
+        self._label_cache = None
         self.cached_surfaces = []
+        self._owned = []  # which surfaces came from the pool
+        self._opaque = []  # which images have no transparent pixels
+        self._sizes = []  # image sizes
         self._dx = []  # image offsets
         self._dy = []
         self.type = None
+        self._cells = []  # grid cells the sprite is indexed under
+        self._key = None  # (layer, placement) order within Sprites.list
         self.set_image(image)
         self._sprites.append_to_list(self)
 
@@ -183,15 +652,31 @@ class Sprite:
         ''' Add an image to the sprite. '''
         while len(self.cached_surfaces) < i + 1:
             self.cached_surfaces.append(None)
+            self._owned.append(False)
+            self._opaque.append(False)
+            self._sizes.append((0, 0))
             self._dx.append(0)
             self._dy.append(0)
         self._dx[i] = dx
         self._dy[i] = dy
+        self._sprites.damage_static(self)
         if isinstance(image, gtk.gdk.Pixbuf):
             w = image.get_width()
             h = image.get_height()
+            opaque = not image.get_has_alpha()
+        elif isinstance(image, cairo.ImageSurface):
+            w = image.get_width()
+            h = image.get_height()
+            opaque = image.get_content() == cairo.CONTENT_COLOR
+        elif isinstance(image, Shape):
+            w, h = image.get_size()
+            opaque = image.is_opaque()
         else:
             w, h = image.get_size()
+            opaque = False
+        self._sizes[i] = (w, h)
+        self._opaque[i] = opaque
+        size = (self.rect.width, self.rect.height)
         if i == 0:  # Always reset width and height when base image changes.
             self.rect.width = w + dx
             self.rect.height = h + dy
@@ -200,27 +685,72 @@ class Sprite:
                 self.rect.width = w + dx
             if h + dy > self.rect.height:
                 self.rect.height = h + dy
-        surface = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32, self.rect.width, self.rect.height)
+        if size != (self.rect.width, self.rect.height):
+            self._invalidate_labels()
+        self._sprites.update_index(self)
+        self._sprites.damage_static(self)
+        self._release_surface(i)
+        if isinstance(image, (cairo.ImageSurface, Shape)):
+            # Already rendered (and maybe shared) or drawn procedurally,
+            # so use it as is.
+            self.cached_surfaces[i] = image
+            return
+        # Opaque images that fill the whole surface need no alpha channel.
+        if opaque and (w, h) == (self.rect.width, self.rect.height):
+            format = cairo.FORMAT_RGB24
+        else:
+            format = cairo.FORMAT_ARGB32
+        surface = self._sprites.pool.get(
+            format, self.rect.width, self.rect.height)
         context = cairo.Context(surface)
         context = gtk.gdk.CairoContext(context)
+        # Pooled surfaces are not blank, so replace rather than blend.
+        context.set_operator(cairo.OPERATOR_SOURCE)
         context.set_source_pixbuf(image, 0, 0)
         context.rectangle(0, 0, self.rect.width, self.rect.height)
         context.fill()
         self.cached_surfaces[i] = surface
+        self._owned[i] = True
+
+    def _release_surface(self, i):
+        ''' Return surface i to the pool if the sprite allocated it '''
+        if self._owned[i]:
+            self._sprites.pool.release(self.cached_surfaces[i])
+            self._owned[i] = False
+        self.cached_surfaces[i] = None
 
     def move(self, pos):
         ''' Move to new (x, y) position '''
-        self.inval()
+        old = self._moving()
         self.rect.x, self.rect.y = int(pos[0]), int(pos[1])
-        self.inval()
+        self._moved(old)
 
     def move_relative(self, pos):
         ''' Move to new (x+dx, y+dy) position '''
-        self.inval()
+        old = self._moving()
         self.rect.x += int(pos[0])
         self.rect.y += int(pos[1])
-        self.inval()
+        self._moved(old)
+
+    def _moving(self):
+        ''' Note the area a sprite is about to move away from '''
+        self._sprites.damage_static(self)
+        return gtk.gdk.Rectangle(self.rect.x, self.rect.y,
+                                 self.rect.width, self.rect.height)
+
+    def _moved(self, old):
+        ''' Re-index a sprite that has moved from old and invalidate both
+        areas, as one rectangle if they overlap '''
+        self._sprites.update_index(self)
+        overlap = old.intersect(self.rect)
+        if overlap.width > 0 and overlap.height > 0:
+            self._sprites.damage_static(self)
+            union = old.union(self.rect)
+            self._sprites.invalidate(union.x, union.y, union.width,
+                                     union.height)
+        else:
+            self._sprites.invalidate(old.x, old.y, old.width, old.height)
+            self.inval()
 
     def get_xy(self):
         ''' Return current (x, y) position '''
@@ -245,27 +775,28 @@ class Sprite:
         self._sprites.remove_from_list(self)
         if layer is not None:
             self.layer = layer
-        for i in range(self._sprites.length_of_list()):
-            if layer < self._sprites.get_sprite(i).layer:
-                self._sprites.insert_in_list(self, i)
-                self.inval()
-                return
         self._sprites.append_to_list(self)
         self.inval()
 
     def set_label(self, new_label, i=0):
         ''' Set the label drawn on the sprite '''
         self._extend_labels_array(i)
-        if type(new_label) is str or type(new_label) is unicode:
-            # pango doesn't like nulls
-            self.labels[i] = new_label.replace("\0", " ")
-        else:
-            self.labels[i] = str(new_label)
+        self.labels[i] = _label_text(new_label)
+        self._invalidate_labels()
         self.inval()
 
+    def fit_label(self, new_label, i=0):
+        ''' Fit a label that is to be set later into the sprite, so that
+        setting it then does not have to lay the text out again '''
+        self._extend_labels_array(i)
+        my_width, my_height = self._label_box()
+        fit_text(_label_text(new_label), self._font, self._scale[i],
+                 my_width, my_height, self._rescale[i], self._wrap[i])
+
     def set_margins(self, l=0, t=0, r=0, b=0):
         ''' Set the margins for drawing the label '''
         self._margins = [l, t, r, b]
+        self._invalidate_labels()
 
     def _extend_labels_array(self, i):
         ''' Append to the labels attribute list '''
@@ -277,36 +808,33 @@ class Sprite:
             self.labels.append(" ")
             self._scale.append(self._scale[0])
             self._rescale.append(self._rescale[0])
+            self._wrap.append(self._wrap[0])
             self._horiz_align.append(self._horiz_align[0])
             self._vert_align.append(self._vert_align[0])
 
     def set_font(self, font):
         ''' Set the font for a label '''
+        self._font = font
         self._fd = pango.FontDescription(font)
+        self._invalidate_labels()
 
     def set_label_color(self, rgb):
         ''' Set the font color for a label '''
-        COLORTABLE = {'black': '#000000', 'white': '#FFFFFF',
-                      'red': '#FF0000', 'yellow': '#FFFF00',
-                      'green': '#00FF00', 'cyan': '#00FFFF',
-                      'blue': '#0000FF', 'purple': '#FF00FF',
-                      'gray': '#808080'}
-        if rgb.lower() in COLORTABLE:
-            rgb = COLORTABLE[rgb.lower()]
-        # Convert from '#RRGGBB' to floats
-        self._color = (int('0x' + rgb[1:3], 16) / 256.,
-                       int('0x' + rgb[3:5], 16) / 256.,
-                       int('0x' + rgb[5:7], 16) / 256.)
+        self._color = _color_to_rgb(rgb)
+        self._invalidate_labels()
         return
 
     def set_label_attributes(self, scale, rescale=True, horiz_align="center",
-                             vert_align="middle", i=0):
-        ''' Set the various label attributes '''
+                             vert_align="middle", i=0, wrap=False):
+        ''' Set the various label attributes; a wrapped label is broken
+        into lines (and only shrunk if the lines do not fit) '''
         self._extend_labels_array(i)
         self._scale[i] = scale
         self._rescale[i] = rescale
+        self._wrap[i] = wrap
         self._horiz_align[i] = horiz_align
         self._vert_align[i] = vert_align
+        self._invalidate_labels()
 
     def hide(self):
         ''' Hide a sprite '''
@@ -317,12 +845,32 @@ class Sprite:
         ''' Restore a hidden sprite '''
         self.set_layer()
 
+    def get_bytes(self):
+        ''' How many bytes do the surfaces the sprite owns (its images
+        and rendered labels) hold? '''
+        total = 0
+        for i, surface in enumerate(self.cached_surfaces):
+            if self._owned[i]:
+                total += surface.get_stride() * surface.get_height()
+        if self._label_cache is not None:
+            for label in self._label_cache:
+                if label is not None:
+                    total += label[0].get_stride() * label[0].get_height()
+        return total
+
+    def release(self):
+        ''' Hide a sprite that will not be used again and recycle its
+        surfaces '''
+        self.hide()
+        for i in range(len(self.cached_surfaces)):
+            self._release_surface(i)
+        self._label_cache = None
+
     def inval(self):
         ''' Invalidate a region for gtk '''
-        self._sprites.widget.queue_draw_area(self.rect.x,
-                                             self.rect.y,
-                                             self.rect.width,
-                                             self.rect.height)
+        self._sprites.damage_static(self)
+        self._sprites.invalidate(self.rect.x, self.rect.y,
+                                 self.rect.width, self.rect.height)
 
     def draw(self, cr=None):
         ''' Draw the sprite (and label) '''
@@ -330,17 +878,33 @@ class Sprite:
             print 'sprite.draw: no Cairo context.'
             return
         for i, surface in enumerate(self.cached_surfaces):
+            if isinstance(surface, Shape):
+                surface.draw(cr, self.rect.x + self._dx[i],
+                             self.rect.y + self._dy[i])
+                continue
+            # Opaque images can be copied rather than blended.
+            if self._opaque[i]:
+                cr.set_operator(cairo.OPERATOR_SOURCE)
             cr.set_source_surface(surface,
                                   self.rect.x + self._dx[i],
                                   self.rect.y + self._dy[i])
             cr.rectangle(self.rect.x + self._dx[i],
                          self.rect.y + self._dy[i],
-                         self.rect.width,
-                         self.rect.height)
+                         self._sizes[i][0],
+                         self._sizes[i][1])
             cr.fill()
+            if self._opaque[i]:
+                cr.set_operator(cairo.OPERATOR_OVER)
         if len(self.labels) > 0:
             self.draw_label(cr)
 
+    def is_opaque(self):
+        ''' Does the base image cover the whole sprite with opaque
+        pixels? '''
+        return len(self.cached_surfaces) > 0 and self._opaque[0] and \
+            self._dx[0] == 0 and self._dy[0] == 0 and \
+            self._sizes[0] == (self.rect.width, self.rect.height)
+
     def hit(self, pos):
         ''' Is (x, y) on top of the sprite? '''
         x, y = pos
@@ -356,52 +920,77 @@ class Sprite:
 
     def draw_label(self, cr):
         ''' Draw the label based on its attributes '''
-        # Create a pangocairo context
-        cr = pangocairo.CairoContext(cr)
+        # The labels are laid out and rendered once, then blitted on
+        # every draw until the text, attributes, or size change.
+        if self._label_cache is None:
+            self._label_cache = [self._render_label(i)
+                                 for i in range(len(self.labels))]
+        for label in self._label_cache:
+            if label is None:
+                continue
+            surface, dx, dy = label
+            cr.set_source_surface(surface, self.rect.x + dx,
+                                  self.rect.y + dy)
+            cr.rectangle(self.rect.x + dx, self.rect.y + dy,
+                         surface.get_width(), surface.get_height())
+            cr.fill()
+
+    def _render_label(self, i):
+        ''' Lay out label i and render it into a surface, returning the
+        surface and its offset from the sprite origin (or None) '''
+        my_width, my_height = self._label_box()
+        text, size = fit_text(self.labels[i], self._font, self._scale[i],
+                              my_width, my_height, self._rescale[i],
+                              self._wrap[i])
+        cr = pangocairo.CairoContext(cairo.Context(_scratch_surface()))
+        pl = cr.create_layout()
+        if self._wrap[i]:
+            pl.set_width(int(my_width * pango.SCALE))
+            pl.set_wrap(pango.WRAP_WORD_CHAR)
+            pl.set_alignment(_ALIGNMENTS[self._horiz_align[i]])
+        pl.set_text(text)
+        self._fd.set_size(int(size * pango.SCALE))
+        pl.set_font_description(self._fd)
+        w, h = pl.get_size()
+        w /= pango.SCALE
+        h /= pango.SCALE
+        if self._wrap[i]:
+            # Pango aligns the lines within the full label width.
+            w = my_width
+        if self._horiz_align[i] == "center":
+            x = int(self._margins[0] + (my_width - w) / 2)
+        elif self._horiz_align[i] == 'left':
+            x = int(self._margins[0])
+        else: # right
+            x = int(self.rect.width - w - self._margins[2])
+        if self._vert_align[i] == "middle":
+            y = int(self._margins[1] + (my_height - h) / 2)
+        elif self._vert_align[i] == "top":
+            y = int(self._margins[1])
+        else: # bottom
+            y = int(self.rect.height - h - self._margins[3])
+        if w < 1 or h < 1:
+            return None
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(w) + 1,
+                                     int(h) + 1)
+        cr = pangocairo.CairoContext(cairo.Context(surface))
+        cr.set_source_rgb(self._color[0], self._color[1], self._color[2])
+        cr.update_layout(pl)
+        cr.show_layout(pl)
+        return (surface, x, y)
+
+    def _label_box(self):
+        ''' The width and height available to a label '''
         my_width = self.rect.width - self._margins[0] - self._margins[2]
         if my_width < 0:
             my_width = 0
         my_height = self.rect.height - self._margins[1] - self._margins[3]
-        for i in range(len(self.labels)):
-            pl = cr.create_layout()
-            pl.set_text(str(self.labels[i]))
-            self._fd.set_size(int(self._scale[i] * pango.SCALE))
-            pl.set_font_description(self._fd)
-            w = pl.get_size()[0] / pango.SCALE
-            if w > my_width:
-                if self._rescale[i]:
-                    self._fd.set_size(
-                            int(self._scale[i] * pango.SCALE * my_width / w))
-                    pl.set_font_description(self._fd)
-                    w = pl.get_size()[0] / pango.SCALE
-                else:
-                    j = len(self.labels[i]) - 1
-                    while(w > my_width and j > 0):
-                        pl.set_text(
-                            "…" + self.labels[i][len(self.labels[i]) - j:])
-                        self._fd.set_size(int(self._scale[i] * pango.SCALE))
-                        pl.set_font_description(self._fd)
-                        w = pl.get_size()[0] / pango.SCALE
-                        j -= 1
-            if self._horiz_align[i] == "center":
-                x = int(self.rect.x + self._margins[0] + (my_width - w) / 2)
-            elif self._horiz_align[i] == 'left':
-                x = int(self.rect.x + self._margins[0])
-            else: # right
-                x = int(self.rect.x + self.rect.width - w - self._margins[2])
-            h = pl.get_size()[1] / pango.SCALE
-            if self._vert_align[i] == "middle":
-                y = int(self.rect.y + self._margins[1] + (my_height - h) / 2)
-            elif self._vert_align[i] == "top":
-                y = int(self.rect.y + self._margins[1])
-            else: # bottom
-                y = int(self.rect.y + self.rect.height - h - self._margins[3])
-            cr.save()
-            cr.translate(x, y)
-            cr.set_source_rgb(self._color[0], self._color[1], self._color[2])
-            cr.update_layout(pl)
-            cr.show_layout(pl)
-            cr.restore()
+        return my_width, my_height
+
+    def _invalidate_labels(self):
+        ''' Discard the rendered labels; they will be redone on demand '''
+        self._label_cache = None
+        self._sprites.damage_static(self)
 
     def label_width(self):
         ''' Calculate the width of a label '''
@@ -443,12 +1032,14 @@ class Sprite:
         # create a new 1x1 cairo surface
         cs = cairo.ImageSurface(cairo.FORMAT_RGB24, 1, 1);
         cr = cairo.Context(cs)
-        cr.set_source_surface(self.cached_surfaces[i], -x, -y)
-        cr.rectangle(0,0,1,1)
-        cr.set_operator(cairo.OPERATOR_SOURCE)
-        cr.fill()
+        if isinstance(self.cached_surfaces[i], Shape):
+            self.cached_surfaces[i].draw(cr, -x, -y)
+        else:
+            cr.set_source_surface(self.cached_surfaces[i], -x, -y)
+            cr.rectangle(0,0,1,1)
+            cr.set_operator(cairo.OPERATOR_SOURCE)
+            cr.fill()
         cs.flush() # ensure all writing is done
         # Read the pixel
         pixels = cs.get_data()
         return (ord(pixels[2]), ord(pixels[1]), ord(pixels[0]), 0)
-
@@ -12,16 +12,23 @@
 
 
 import gtk
+import gobject
+import cairo
 import os
+import struct
 import subprocess
 
 from gettext import gettext as _
 
+from sprites import Shape
+
 XO1 = 'xo1'
 XO15 = 'xo1.5'
 XO175 = 'xo1.75'
 UNKNOWN = 'unknown'
 
+_CHUNK_SIZE = 64 * 1024  # bytes fed to the image loader at a time
+
 
 def play_audio_from_file(file_path):
     """ Audio media """
@@ -81,31 +88,29 @@ def lighter_color(colors):
     return 1
 
 
-def svg_str_to_pixbuf(svg_string):
-    ''' Load pixbuf from SVG string '''
-    pl = gtk.gdk.PixbufLoader('svg')
-    pl.write(svg_string)
-    pl.close()
-    pixbuf = pl.get_pixbuf()
-    return pixbuf
+def pixbuf_to_surface(pixbuf):
+    ''' Render a pixbuf into a cairo image surface (without an alpha
+    channel if the pixbuf has none) '''
+    if pixbuf.get_has_alpha():
+        format = cairo.FORMAT_ARGB32
+    else:
+        format = cairo.FORMAT_RGB24
+    surface = cairo.ImageSurface(format, pixbuf.get_width(),
+                                 pixbuf.get_height())
+    context = gtk.gdk.CairoContext(cairo.Context(surface))
+    context.set_source_pixbuf(pixbuf, 0, 0)
+    context.paint()
+    return surface
 
 
-def svg_rectangle(width, height, colors):
-    ''' Generate a rectangle frame in two colors '''
-    svg = SVG()
-    svg.set_colors(colors)
-    svg.set_stroke_width(5.0)
-    svg_string = svg.header(width, height, background=False)
-    svg.set_colors([colors[1], 'none'])
-    width -= 5
-    height -= 5
-    svg_string += svg.rect(width, height, 0, 0, 2.5, 2.5)
-    svg.set_colors([colors[0], 'none'])
-    width -= 10
-    height -= 10
-    svg_string += svg.rect(width, height, 0, 0, 7.5, 7.5)
-    svg_string += svg.footer()
-    return svg_string
+def frame_shape(width, height, colors):
+    ''' A rectangle frame in two colors, drawn without SVG '''
+    shape = Shape(width, height)
+    shape.add_rect(2.5, 2.5, width - 5, height - 5, stroke=colors[1],
+                   stroke_width=5.0)
+    shape.add_rect(7.5, 7.5, width - 15, height - 15, stroke=colors[0],
+                   stroke_width=5.0)
+    return shape
 
 
 def load_svg_from_file(file_path, width, height):
@@ -113,6 +118,145 @@ def load_svg_from_file(file_path, width, height):
     return gtk.gdk.pixbuf_new_from_file_at_size(file_path, width, height)
 
 
+def _fit_size(width, height, max_width, max_height):
+    ''' Scale (width, height) to fit max_width x max_height, keeping the
+    aspect ratio '''
+    scale = min(float(max_width) / width, float(max_height) / height)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def _size_prepared_cb(loader, width, height, max_width, max_height):
+    ''' Ask the loader to decode straight to the size we want. '''
+    loader.set_size(*_fit_size(width, height, max_width, max_height))
+
+
+def _jpeg_segments(fd):
+    ''' Yield (marker, data) for each JPEG header segment, stopping at
+    the start of the compressed image data. '''
+    if fd.read(2) != '\xff\xd8':
+        return
+    while True:
+        marker = fd.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            return
+        while marker[1] == '\xff':  # padding
+            marker = '\xff' + fd.read(1)
+            if len(marker) < 2:
+                return
+        if marker[1] in '\xd9\xda':  # end of image, start of scan
+            return
+        length = fd.read(2)
+        if len(length) < 2:
+            return
+        yield ord(marker[1]), fd.read(struct.unpack('>H', length)[0] - 2)
+
+
+def _exif_thumbnail_data(data):
+    ''' Return the JPEG thumbnail stored in IFD1 of an EXIF segment. '''
+    if not data.startswith('Exif\x00\x00'):
+        return None
+    tiff = data[6:]
+    if tiff[:2] == 'II':
+        order = '<'
+    elif tiff[:2] == 'MM':
+        order = '>'
+    else:
+        return None
+    try:
+        ifd0 = struct.unpack(order + 'I', tiff[4:8])[0]
+        count = struct.unpack(order + 'H', tiff[ifd0:ifd0 + 2])[0]
+        next_ifd = ifd0 + 2 + 12 * count
+        ifd1 = struct.unpack(order + 'I', tiff[next_ifd:next_ifd + 4])[0]
+        if ifd1 == 0:
+            return None
+        count = struct.unpack(order + 'H', tiff[ifd1:ifd1 + 2])[0]
+        tags = {}
+        for entry in range(ifd1 + 2, ifd1 + 2 + 12 * count, 12):
+            tag = struct.unpack(order + 'H', tiff[entry:entry + 2])[0]
+            tags[tag] = struct.unpack(order + 'I',
+                                      tiff[entry + 8:entry + 12])[0]
+    except struct.error:
+        return None
+    if 0x0201 not in tags or 0x0202 not in tags:
+        return None
+    thumbnail = tiff[tags[0x0201]:tags[0x0201] + tags[0x0202]]
+    if not thumbnail.startswith('\xff\xd8'):
+        return None
+    return thumbnail
+
+
+def _exif_thumbnail(file_path, max_width, max_height):
+    ''' Return the thumbnail embedded in a JPEG file if it has the same
+    shape as the image and is at least as big as we need, else None. '''
+    fd = open(file_path, 'rb')
+    try:
+        size = None
+        thumbnail = None
+        try:
+            for marker, data in _jpeg_segments(fd):
+                if marker == 0xe1 and thumbnail is None:
+                    thumbnail = _exif_thumbnail_data(data)
+                elif 0xc0 <= marker <= 0xcf and \
+                        marker not in (0xc4, 0xc8, 0xcc):
+                    height, width = struct.unpack('>HH', data[1:5])
+                    size = (width, height)
+                    break
+        except (struct.error, IndexError, ValueError):
+            return None  # a damaged file: decode the image itself
+    finally:
+        fd.close()
+    if thumbnail is None or size is None or 0 in size:
+        return None
+    loader = gtk.gdk.PixbufLoader('jpeg')
+    try:
+        loader.write(thumbnail)
+        loader.close()
+    except gobject.GError:
+        return None
+    pixbuf = loader.get_pixbuf()
+    if pixbuf is None:
+        return None
+    width, height = _fit_size(size[0], size[1], max_width, max_height)
+    if pixbuf.get_width() < width or pixbuf.get_height() < height:
+        return None
+    # Some cameras letterbox the thumbnail of a wide image.
+    aspect = float(size[0]) / size[1]
+    if abs(float(pixbuf.get_width()) / pixbuf.get_height() - aspect) > \
+            0.02 * aspect:
+        return None
+    if (pixbuf.get_width(), pixbuf.get_height()) == (width, height):
+        return pixbuf
+    return pixbuf.scale_simple(width, height, gtk.gdk.INTERP_BILINEAR)
+
+
+def load_pixbuf_at_size(file_path, width, height):
+    ''' Load an image file scaled to fit width x height. The thumbnail in
+    a JPEG's EXIF data is used if it is big enough; otherwise the loader
+    is given the size as soon as it knows the image size, so that JPEGs
+    are scaled while decoding rather than decoded in full first. '''
+    pixbuf = _exif_thumbnail(file_path, width, height)
+    if pixbuf is not None:
+        return pixbuf
+    loader = gtk.gdk.PixbufLoader()
+    loader.connect('size-prepared', _size_prepared_cb, width, height)
+    fd = open(file_path, 'rb')
+    try:
+        data = fd.read(_CHUNK_SIZE)
+        while data:
+            loader.write(data)
+            data = fd.read(_CHUNK_SIZE)
+    except:
+        try:
+            loader.close()
+        except gobject.GError:
+            pass
+        raise
+    finally:
+        fd.close()
+    loader.close()
+    return loader.get_pixbuf()
+
+
 def file_to_base64(activity, path):
     base64 = os.path.join(get_path(activity, 'instance'), 'base64tmp')
     cmd = 'base64 <' + path + ' >' + base64
@@ -177,13 +321,16 @@ def svg_xo_chat(colors):
     return svg_string
 
 
-def genblank(w, h, colors, stroke_width=1.0):
-    svg = SVG()
-    svg.set_colors(colors)
-    svg.set_stroke_width(stroke_width)
-    svg_string = svg.header(w, h)
-    svg_string += svg.footer()
-    return svg_string
+def blank_shape(w, h, colors, stroke_width=1.0):
+    ''' A filled, outlined background in two colors '''
+    shape = Shape(w, h)
+    if colors[0] == colors[1]:
+        shape.add_rect(0, 0, w, h, fill=colors[1])
+    else:
+        shape.add_rect(0.25, 0.25, w - 0.5, h - 0.5, radius=1,
+                       fill=colors[1], stroke=colors[0],
+                       stroke_width=stroke_width)
+    return shape
 
 
 class SVG: